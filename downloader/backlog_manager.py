@@ -1,88 +1,489 @@
 """
 Backlog Manager
 Manages the queue of tracks waiting to be downloaded
+
+The backlog is stored as an append-only JSON Lines log: every added track is
+one line, and every removal appends a tombstone line ({"op": "del", ...}).
+Updates to a queued track (retry bookkeeping) append {"op": "upd", ...} lines.
+The in-memory list is authoritative for this process; lines appended by other
+processes sharing the file (watcher and downloader) are picked up before each
+operation, and the log is compacted once tombstones pile up.
 """
+import heapq
+import itertools
 import json
+import logging
 import os
+import tempfile
+import threading
+import time
+from collections import deque
 from pathlib import Path
-from typing import List, Dict, Optional
+from typing import Deque, List, Dict, Iterable, Optional, Set, Tuple
 from datetime import datetime
 
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+
+if orjson is not None:
+    _loads = orjson.loads
+
+    def _dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+else:
+    _loads = json.loads
+
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj, separators=(",", ":")).encode()
+
+
+# Compact the log once tombstones make up this fraction of its lines
+COMPACT_RATIO = 0.25
+# ...but never bother for tiny logs
+COMPACT_MIN_LINES = 64
+
+# Backlog directories already created by this process
+_initialized_dirs: Set[Path] = set()
+
+
+def _retry_at(track: Dict) -> float:
+    """Epoch time before which a backed-off track should not be retried"""
+    next_retry_at = track.get("next_retry_at")
+    return datetime.fromisoformat(next_retry_at).timestamp() if next_retry_at else 0.0
+
 
 class BacklogManager:
     """Manages backlog of tracks to download"""
-    
-    def __init__(self, backlog_file: str = "/app/data/backlog.json"):
+
+    def __init__(self, backlog_file: str = "/app/data/backlog.jsonl", failed_file: Optional[str] = None):
         self.backlog_file = Path(backlog_file)
-        self.backlog_file.parent.mkdir(parents=True, exist_ok=True)
-        self._ensure_backlog_exists()
-    
-    def _ensure_backlog_exists(self):
-        """Create backlog file if it doesn't exist"""
-        if not self.backlog_file.exists():
-            self._write_backlog([])
-    
-    def _read_backlog(self) -> List[Dict]:
-        """Read backlog from file"""
+        # Tracks that were given up on are moved here
+        self.failed_file = Path(failed_file) if failed_file else self.backlog_file.with_name("failed.jsonl")
+        if self.backlog_file.parent not in _initialized_dirs:
+            self.backlog_file.parent.mkdir(parents=True, exist_ok=True)
+            _initialized_dirs.add(self.backlog_file.parent)
+
+        self._tracks: Deque[Dict] = deque()
+        # Backed-off tracks found at the head of the queue, soonest retry first
+        self._deferred: List[Tuple[float, int, Dict]] = []
+        self._deferred_seq = itertools.count()
+        # Tracks handed out by pop_next() that are still in the log
+        self._claimed: Dict[str, Dict] = {}
+        # Every live entry (queued, deferred or claimed) by track id, for O(1) lookups
+        self._by_id: Dict[str, Dict] = {}
+        self._lines = 0
+        # Log lines a compaction would drop (tombstones and updates)
+        self._tombstones = 0
+        self._offset = 0
+        self._inode: Optional[int] = None
+        # Ids dropped by tombstones whose entries are still in _tracks
+        self._removed: Set[str] = set()
+        # Entries held back while inside a `with backlog:` block
+        self._pending: List[Dict] = []
+        self._batch_depth = 0
+        # One manager may be shared by several threads; guards all of the above
+        self._lock = threading.RLock()
+
+        self._open_log()
+        self._migrate_legacy_backlog()
+        self._load()
+        self._compact()
+
+    def _migrate_legacy_backlog(self):
+        """
+        Convert a pre-JSONL backlog (a single JSON array) to the log format
+        Runs under the log's flock: the watcher and downloader start together
+        and must not both convert (and overwrite each other's appends)
+        """
+        while True:
+            if fcntl is not None:
+                fcntl.flock(self._fp.fileno(), fcntl.LOCK_EX)
+            # The other process may have converted (replaced) the log while we waited
+            if os.stat(self.backlog_file).st_ino == os.fstat(self._fp.fileno()).st_ino:
+                break
+            self._unlock_file()
+            self._fp.close()
+            self._open_log()
+
+        migrated = False
         try:
-            with open(self.backlog_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except (json.JSONDecodeError, FileNotFoundError):
-            return []
-    
-    def _write_backlog(self, backlog: List[Dict]):
-        """Write backlog to file"""
-        with open(self.backlog_file, 'w', encoding='utf-8') as f:
-            json.dump(backlog, f, indent=2, ensure_ascii=False)
-    
+            # Re-checked under the lock: the old array at the configured path, or
+            # (upgrading with the default path) an old backlog.json next to a new, empty log
+            legacy_file = self.backlog_file
+            data = legacy_file.read_bytes()
+            if not data:
+                legacy_file = self.backlog_file.with_suffix(".json")
+                if legacy_file == self.backlog_file or not legacy_file.exists():
+                    return
+                data = legacy_file.read_bytes()
+            if data.lstrip()[:1] != b"[":
+                return
+            try:
+                tracks = _loads(data)
+            except json.JSONDecodeError as e:
+                logger.error(f"Backlog file {legacy_file} is not valid JSON, leaving it untouched: {e}")
+                return
+
+            logger.info(f"Converting {len(tracks)} track(s) from {legacy_file} to {self.backlog_file}")
+            self._replace_log(tracks)
+            if legacy_file != self.backlog_file:
+                # Keep it, but make sure an emptied log never re-imports it
+                legacy_file.replace(legacy_file.with_name(f"{legacy_file.name}.migrated"))
+            migrated = True
+        finally:
+            self._unlock_file()
+            if migrated:
+                self._fp.close()
+                self._open_log()
+
+    def _replace_log(self, tracks: List[Dict]):
+        """Atomically replace the log with one line per track"""
+        # Unique scratch file next to the log: the containers sharing it may have the same PID
+        fd, tmp_file = tempfile.mkstemp(dir=self.backlog_file.parent, prefix=f"{self.backlog_file.name}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                os.fchmod(f.fileno(), 0o644)  # mkstemp creates it private
+                f.write(b"".join(self._encode(track) for track in tracks))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.backlog_file)
+        except BaseException:
+            os.unlink(tmp_file)
+            raise
+
+    @staticmethod
+    def _encode(entry: Dict) -> bytes:
+        """Serialize one log entry as a compact JSONL line"""
+        return _dumps(entry) + b"\n"
+
+    def _apply(self, entry: Dict, logged: bool = True):
+        """
+        Apply one log entry to the in-memory state
+        Call _prune() once done applying a batch of entries
+        """
+        if logged:
+            self._lines += 1
+        track_id = entry["track_id"]
+        op = entry.get("op")
+        if op == "del":
+            if logged:
+                self._tombstones += 1
+            if self._by_id.pop(track_id, None) is not None:
+                self._removed.add(track_id)
+        elif op == "upd":
+            if logged:
+                self._tombstones += 1
+            track = self._by_id.get(track_id)
+            if track is not None:
+                track.update((k, v) for k, v in entry.items() if k != "op")
+        elif track_id not in self._by_id:
+            if track_id in self._removed:
+                # Re-added after removal: drop the stale entry first
+                self._prune()
+            self._by_id[track_id] = entry
+            self._tracks.append(entry)
+
+    def _prune(self):
+        """Drop all entries removed by tombstones in a single pass"""
+        if self._removed:
+            self._tracks = deque(t for t in self._tracks if t["track_id"] not in self._removed)
+            if self._deferred:
+                self._deferred = [item for item in self._deferred if item[2]["track_id"] not in self._removed]
+                heapq.heapify(self._deferred)
+            for track_id in self._removed:
+                self._claimed.pop(track_id, None)
+            self._removed.clear()
+
+    def _load(self):
+        """(Re)build the in-memory state by scanning the whole log"""
+        self._tracks = deque()
+        self._deferred = []
+        self._by_id = {}
+        self._lines = 0
+        self._tombstones = 0
+        self._offset = 0
+        self._removed = set()
+        self._inode = os.fstat(self._fp.fileno()).st_ino
+        self._read_tail()
+        # Entries not flushed yet still apply on top of the rescanned log
+        for entry in self._pending:
+            self._apply(entry, logged=False)
+        self._prune()
+        # Claimed tracks stay claimed (as the freshly loaded entries); drop the
+        # ones removed while we were away
+        if self._claimed:
+            self._claimed = {i: self._by_id[i] for i in self._claimed if i in self._by_id}
+            self._tracks = deque(t for t in self._tracks if t["track_id"] not in self._claimed)
+
+    def _read_tail(self):
+        """Apply any lines appended since the last read"""
+        with open(self.backlog_file, 'rb') as f:
+            if os.fstat(f.fileno()).st_ino != self._inode:
+                return  # Replaced since we last looked; the next _sync rescans
+            f.seek(self._offset)
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    break  # Partial line still being written by another process
+                self._offset += len(raw)
+                line = raw.strip()
+                if not line:
+                    continue
+                try:
+                    self._apply(_loads(line))
+                except (json.JSONDecodeError, KeyError) as e:
+                    logger.warning(f"Skipping corrupt backlog entry at byte {self._offset - len(raw)}: {e}")
+        self._prune()
+
+    def _open_log(self):
+        """Open (creating if needed) the append handle for the current log file"""
+        # Unbuffered: every append is a single write() on an O_APPEND handle
+        self._fp = open(self.backlog_file, 'ab', buffering=0)
+
+    def _sync(self) -> bool:
+        """
+        Catch up with changes made by other processes sharing the log
+        Returns True if the log had been replaced and was reopened
+        """
+        try:
+            st = os.stat(self.backlog_file)
+        except FileNotFoundError:
+            st = None
+
+        if st is not None and st.st_ino == self._inode:
+            # Same file: only open it if something was appended since last read
+            if st.st_size != self._offset:
+                self._read_tail()
+            return False
+
+        if st is None:
+            logger.warning(f"Backlog file {self.backlog_file} disappeared, starting a new one")
+        # Another process compacted (replaced) the log: reopen and rescan
+        self._fp.close()
+        self._open_log()
+        self._load()
+        return True
+
+    def _lock_file(self):
+        """Take the cross-process write lock on the current log file"""
+        while True:
+            if fcntl is not None:
+                fcntl.flock(self._fp.fileno(), fcntl.LOCK_EX)
+            # If the log was replaced while we waited, the lock we got is on
+            # the old file (and was released when it was closed): retry
+            if not self._sync():
+                return
+
+    def _unlock_file(self):
+        if fcntl is not None:
+            fcntl.flock(self._fp.fileno(), fcntl.LOCK_UN)
+
+    def _append(self, entries: List[Dict]):
+        """Append entries to the log (deferred inside a batch) and apply them in memory"""
+        if not entries:
+            return
+        if self._batch_depth:
+            self._pending.extend(entries)
+            for entry in entries:
+                self._apply(entry, logged=False)
+            self._prune()
+        else:
+            self._write(entries)
+
+    def _write(self, entries: List[Dict], durable: bool = False):
+        """Write entries to the log in one call, then read them back in log order"""
+        self._lock_file()
+        try:
+            self._fp.write(b"".join(self._encode(entry) for entry in entries))
+            if durable:
+                os.fsync(self._fp.fileno())
+            self._read_tail()
+        finally:
+            self._unlock_file()
+
+    def __enter__(self) -> "BacklogManager":
+        """Defer log writes until the outermost `with` block exits"""
+        with self._lock:
+            self._batch_depth += 1
+            return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self._lock:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                self.flush()
+
+    def flush(self):
+        """Write out (and fsync) all deferred entries"""
+        with self._lock:
+            if not self._pending:
+                return
+            entries, self._pending = self._pending, []
+            self._write(entries, durable=True)
+
+    def _compact(self, force: bool = False):
+        """Rewrite the log from the in-memory state if tombstones pile up"""
+        if not force and (
+            self._batch_depth
+            or self._lines < COMPACT_MIN_LINES
+            or self._tombstones < self._lines * COMPACT_RATIO
+        ):
+            return
+        self.flush()
+
+        self._lock_file()
+        try:
+            # Replace rather than truncate so processes tailing the old file
+            # notice the new inode and rescan instead of reading from a stale offset
+            self._replace_log([*self._claimed.values(), *self._tracks, *self._deferred_tracks()])
+        finally:
+            self._unlock_file()
+
+        self._fp.close()
+        self._open_log()
+        self._load()
+
     def add_track(self, track_info: Dict) -> bool:
         """
         Add track to backlog if not already present
         Returns True if added, False if already exists
         """
-        backlog = self._read_backlog()
-        track_id = track_info["track_id"]
-        
-        # Check if track already in backlog
-        if any(item["track_id"] == track_id for item in backlog):
-            return False
-        
-        # Add timestamp if not present
-        if "added_at" not in track_info:
-            track_info["added_at"] = datetime.now().isoformat()
-        
-        backlog.append(track_info)
-        self._write_backlog(backlog)
-        return True
-    
+        with self._lock:
+            self._sync()
+            track_id = track_info["track_id"]
+
+            # Check if track already in backlog
+            if track_id in self._by_id:
+                return False
+
+            # Listener tracks carry a raw epoch; store it like added_at (local time ISO string)
+            timestamp_ns = track_info.pop("timestamp_ns", None)
+            if timestamp_ns is not None:
+                track_info["timestamp"] = datetime.fromtimestamp(timestamp_ns / 1e9).isoformat()
+
+            # Add timestamp if not present
+            if "added_at" not in track_info:
+                track_info["added_at"] = datetime.now().isoformat()
+
+            self._append([track_info])
+            return True
+
     def get_next_track(self) -> Optional[Dict]:
         """Get next track from backlog (FIFO)"""
-        backlog = self._read_backlog()
-        if not backlog:
+        with self._lock:
+            self._sync()
+            return self._tracks[0] if self._tracks else None
+
+    def pop_next(self) -> Optional[Dict]:
+        """
+        Take the next track off the queue (FIFO, skipping tracks still backing off)
+        The track stays in the backlog file until it is removed with
+        remove_track(s), or is put back in the queue with requeue()
+        """
+        with self._lock:
+            self._sync()
+            now = time.time()
+            # Backed-off tracks whose retry time has come were queued earlier: go first
+            if self._deferred and self._deferred[0][0] <= now:
+                return self._claim(heapq.heappop(self._deferred)[2])
+            while self._tracks:
+                track = self._tracks.popleft()
+                retry_at = _retry_at(track)
+                if retry_at <= now:
+                    return self._claim(track)
+                heapq.heappush(self._deferred, (retry_at, next(self._deferred_seq), track))
             return None
-        
-        return backlog[0]
-    
+
+    def _claim(self, track: Dict) -> Dict:
+        self._claimed[track["track_id"]] = track
+        return track
+
+    def _deferred_tracks(self) -> List[Dict]:
+        return [item[2] for item in sorted(self._deferred)]
+
+    def requeue(self, track: Dict) -> bool:
+        """
+        Put a track taken with pop_next() back in the queue: at the end, or
+        with the backed-off tracks if its next_retry_at is still ahead
+        """
+        with self._lock:
+            track = self._claimed.pop(track["track_id"], None)
+            if track is None:
+                return False
+            retry_at = _retry_at(track)
+            if retry_at > time.time():
+                heapq.heappush(self._deferred, (retry_at, next(self._deferred_seq), track))
+            else:
+                self._tracks.append(track)
+            return True
+
+    def update_track(self, track_id: str, updates: Dict) -> bool:
+        """
+        Update fields of a track in the backlog
+        Returns True if updated, False if not in backlog
+        """
+        with self._lock:
+            self._sync()
+            if track_id not in self._by_id:
+                return False
+            self._append([{**updates, "op": "upd", "track_id": track_id}])
+            return True
+
+    def move_to_failed(self, track_ids: Iterable[str]) -> int:
+        """
+        Move tracks out of the backlog into the failed tracks file
+        Returns number of tracks moved
+        """
+        with self._lock:
+            self._sync()
+            tracks = [self._by_id[track_id] for track_id in set(track_ids) if track_id in self._by_id]
+            if not tracks:
+                return 0
+            with open(self.failed_file, 'ab') as f:
+                f.write(b"".join(self._encode(track) for track in tracks))
+            self._append([{"op": "del", "track_id": track["track_id"]} for track in tracks])
+            return len(tracks)
+
     def remove_track(self, track_id: str) -> bool:
         """Remove track from backlog by track_id"""
-        backlog = self._read_backlog()
-        original_length = len(backlog)
-        backlog = [item for item in backlog if item["track_id"] != track_id]
-        
-        if len(backlog) < original_length:
-            self._write_backlog(backlog)
-            return True
-        return False
-    
+        return self.remove_tracks([track_id]) == 1
+
+    def remove_tracks(self, track_ids: Iterable[str]) -> int:
+        """
+        Remove several tracks from backlog with a single log write
+        Returns number of tracks removed
+        """
+        with self._lock:
+            self._sync()
+            removed = {track_id for track_id in track_ids if track_id in self._by_id}
+            self._append([{"op": "del", "track_id": track_id} for track_id in removed])
+            return len(removed)
+
     def get_all_tracks(self) -> List[Dict]:
         """Get all tracks in backlog"""
-        return self._read_backlog()
-    
+        with self._lock:
+            self._sync()
+            return [*self._tracks, *self._deferred_tracks()]
+
     def clear_backlog(self):
         """Clear entire backlog"""
-        self._write_backlog([])
-    
+        with self._lock:
+            self._sync()
+            self._append([{"op": "del", "track_id": track_id} for track_id in list(self._by_id)])
+            self._compact(force=True)
+
     def get_backlog_size(self) -> int:
         """Get number of tracks in backlog"""
-        return len(self._read_backlog())
-
+        with self._lock:
+            self._sync()
+            self._compact()
+            return len(self._by_id)
@@ -2,12 +2,12 @@
 Download Processor
 Processes backlog tracks using zotify with the downloading account
 """
-import os
 import sys
 import argparse
+import functools
 import logging
-from pathlib import Path
-from typing import Optional, Dict
+from datetime import datetime, timedelta
+from typing import Optional, Dict, List, Tuple
 
 # Add zotify to path
 sys.path.insert(0, '/app')
@@ -15,10 +15,26 @@ sys.path.insert(0, '/app')
 logger = logging.getLogger(__name__)
 
 from zotify.app import download_from_urls
-from zotify.config import Config, CONFIG_VALUES
+from zotify.track import download_track as zotify_download_track
+from zotify.config import CONFIG_VALUES
+from zotify.utils import regex_input_for_urls
 from zotify.zotify import Zotify
 from librespot.audio.decoders import AudioQuality
 
+# Give up on a track (move it to the failed tracks file) after this many failed downloads
+MAX_DOWNLOAD_ATTEMPTS = 10
+# Wait 2^attempts minutes before retrying a failed track, up to this many minutes
+MAX_RETRY_BACKOFF_MINUTES = 3600
+
+# zotify argument names for every config value, computed once at import
+_CONFIG_ARG_NAMES = tuple(key.lower().replace('_', '-') for key in CONFIG_VALUES)
+
+
+@functools.lru_cache(maxsize=1)
+def _is_premium() -> bool:
+    """Whether the downloading account is premium (asks Spotify only once per process)"""
+    return Zotify.check_premium()
+
 
 class DownloadProcessor:
     """Processes downloads from backlog using zotify"""
@@ -37,80 +53,80 @@ class DownloadProcessor:
         logger.info("Initializing zotify session...")
         
         # Create args object for zotify
-        args = argparse.Namespace()
-        args.username = self.download_username
-        args.password = self.download_password
-        args.config_location = None
-        args.no_splash = True
-        
-        # Set download folder (Music folder is mapped directly via Docker)
-        args.root_path = self.download_folder
-        
-        # Set all config values to None (will use defaults from config file)
-        for key in CONFIG_VALUES:
-            attr_name = key.lower().replace('_', '-')
-            setattr(args, attr_name, None)
-        
-        # Explicitly enable skip_existing to prevent duplicate downloads
-        args.skip_existing = True
-        
-        # Set output format: {artist}/{album}/{song_name}.{ext}
-        # This must be set after the loop to ensure it's not overridden
-        args.output = "{artist}/{album}/{song_name}.{ext}"
+        args = argparse.Namespace(**{
+            # Set all config values to None (will use defaults from config file)
+            **dict.fromkeys(_CONFIG_ARG_NAMES),
+            # Explicit values below must come after the defaults so they win
+            'username': self.download_username,
+            'password': self.download_password,
+            'config_location': None,
+            'no_splash': True,
+            # Set download folder (Music folder is mapped directly via Docker)
+            'root_path': self.download_folder,
+            # Explicitly enable skip_existing to prevent duplicate downloads
+            'skip_existing': True,
+            # Set output format: {artist}/{album}/{song_name}.{ext}
+            'output': "{artist}/{album}/{song_name}.{ext}",
+        })
         
         # Initialize zotify
         Zotify(args)
         
-        # Set download quality
-        quality_options = {
-            'auto': AudioQuality.VERY_HIGH if Zotify.check_premium() else AudioQuality.HIGH,
-            'normal': AudioQuality.NORMAL,
-            'high': AudioQuality.HIGH,
-            'very_high': AudioQuality.VERY_HIGH
-        }
-        Zotify.DOWNLOAD_QUALITY = quality_options.get('auto', AudioQuality.HIGH)
+        # Set download quality ('auto': the best the account can get)
+        is_premium = _is_premium()
+        Zotify.DOWNLOAD_QUALITY = AudioQuality.VERY_HIGH if is_premium else AudioQuality.HIGH
         
-        is_premium = Zotify.check_premium()
         logger.info(f"Zotify initialized successfully (Premium: {is_premium}, Quality: {Zotify.DOWNLOAD_QUALITY})")
         self._zotify_initialized = True
         
-    def download_track(self, track_info: Dict) -> bool:
-        """
-        Download a single track using zotify
-        Returns True if successful, False otherwise
-        """
+    @staticmethod
+    def _normalize_url(track_info: Dict) -> Optional[str]:
+        """Spotify URL to download a backlog entry from, or None if it has no usable URL"""
         spotify_url = track_info.get("spotify_url") or track_info.get("uri", "")
         
         # Convert URI to URL if needed
         if spotify_url.startswith("spotify:track:"):
-            track_id = spotify_url.replace("spotify:track:", "")
-            spotify_url = f"https://open.spotify.com/track/{track_id}"
+            spotify_url = f"https://open.spotify.com/track/{spotify_url.removeprefix('spotify:track:')}"
         
-        if not spotify_url or not spotify_url.startswith("http"):
-            logger.error(f"Invalid URL for track {track_info.get('track_id')}: {spotify_url}")
-            return False
-        
-        try:
-            # Initialize zotify if needed
-            self._initialize_zotify()
-            
-            # Download the track
-            track_name = track_info.get('track_name', 'Unknown')
-            artists = ', '.join(track_info.get('artists', []))
-            logger.info(f"Downloading: {track_name} by {artists}")
-            
-            success = download_from_urls([spotify_url])
-            
-            if success:
-                logger.info(f"Successfully downloaded: {track_name} by {artists}")
-            else:
-                logger.warning(f"Download returned False for: {track_name} by {artists}")
-            
-            return success
+        return spotify_url if spotify_url.startswith("http") else None
+    
+    def _download_urls(self, tracks: List[Tuple[Dict, str]]) -> List[bool]:
+        """
+        Download (track, normalized URL) pairs
+        Returns one success flag per pair, in the same order
+        """
+        if not tracks:
+            return []
+        
+        # The session is set up once by the service loop, not per track
+        assert self._zotify_initialized, "_initialize_zotify() must be called before downloading"
+        
+        # One track at a time: zotify's download routines share module state and
+        # name their temp files after the album folder (convert_audio_format writes
+        # '<album>.tmp'), so parallel downloads of one album overwrite each other
+        results = []
+        for track_info, url in tracks:
+            try:
+                track_name = track_info.get('track_name', 'Unknown')
+                artists = ', '.join(track_info.get('artists', []))
+                logger.info(f"Downloading: {track_name} by {artists}")
+                
+                track_id = regex_input_for_urls(url)[0]
+                if track_id is not None:
+                    # Backlog entries are single tracks: call zotify's track
+                    # routine directly instead of re-dispatching on the URL type
+                    zotify_download_track('single', track_id)
+                    success = True
+                else:
+                    success = download_from_urls([url])
+            except Exception as e:
+                logger.exception(f"Error downloading track {track_info.get('track_id')}: {e}")
+                success = False
             
-        except Exception as e:
-            logger.error(f"Error downloading track {track_info.get('track_id')}: {e}", exc_info=True)
-            return False
+            if not success:
+                logger.warning(f"Download returned False for: {track_info.get('track_name', 'Unknown')}")
+            results.append(success)
+        return results
     
     def process_backlog(self, backlog_manager, max_tracks: int = 10) -> int:
         """
@@ -118,23 +134,74 @@ class DownloadProcessor:
         Returns number of tracks successfully downloaded
         """
         downloaded = 0
+        claimed = []
+        removed = []
+        failed = []
         
-        for _ in range(max_tracks):
-            track = backlog_manager.get_next_track()
-            if not track:
-                break
+        try:
+            for _ in range(max_tracks):
+                track = backlog_manager.pop_next()
+                if not track:
+                    break
+                claimed.append(track)
+                logger.info(f"Processing track: {track.get('track_name', 'Unknown')} ({track['track_id']})")
             
-            track_id = track["track_id"]
-            track_name = track.get('track_name', 'Unknown')
-            logger.info(f"Processing track: {track_name} ({track_id})")
+            # Check URLs before touching zotify; entries without a usable URL
+            # can never succeed, so get them out of the queue right away
+            valid = []
+            invalid = []
+            for track in claimed:
+                url = self._normalize_url(track)
+                if url:
+                    valid.append((track, url))
+                else:
+                    logger.error(f"Invalid URL for track {track['track_id']}: {track.get('spotify_url') or track.get('uri', '')}")
+                    invalid.append(track["track_id"])
+            if invalid:
+                logger.error(f"Moving {len(invalid)} track(s) without a valid URL to {backlog_manager.failed_file}")
+                backlog_manager.move_to_failed(invalid)
             
-            if self.download_track(track):
-                backlog_manager.remove_track(track_id)
-                downloaded += 1
-                logger.info(f"Successfully downloaded and removed from backlog: {track_name}")
-            else:
-                logger.warning(f"Failed to download: {track_name}, keeping in backlog for retry")
-                # Keep in backlog for retry later
+            for (track, _), success in zip(valid, self._download_urls(valid)):
+                track_name = track.get('track_name', 'Unknown')
+                if success:
+                    removed.append(track["track_id"])
+                    downloaded += 1
+                    logger.info(f"Successfully downloaded: {track_name}")
+                else:
+                    failed.append(track)
+        finally:
+            # Record everything in one log write, even if a download blew up
+            # halfway through the batch
+            with backlog_manager:
+                if removed:
+                    backlog_manager.remove_tracks(removed)
+                    logger.info(f"Removed {len(removed)} downloaded track(s) from backlog")
+                self._schedule_retries(backlog_manager, failed)
+                # Failed (now backing off) and interrupted tracks go back in the queue
+                for track in claimed:
+                    backlog_manager.requeue(track)
         
         return downloaded
-
+    
+    def _schedule_retries(self, backlog_manager, tracks: List[Dict]):
+        """Back off failed tracks exponentially, giving up after MAX_DOWNLOAD_ATTEMPTS"""
+        given_up = []
+        now = datetime.now()
+        for track in tracks:
+            track_name = track.get('track_name', 'Unknown')
+            attempts = track.get("attempts", 0) + 1
+            if attempts >= MAX_DOWNLOAD_ATTEMPTS:
+                logger.error(f"Failed to download {track_name} {attempts} times, giving up")
+                given_up.append(track["track_id"])
+                continue
+            
+            backoff = timedelta(minutes=min(2 ** attempts, MAX_RETRY_BACKOFF_MINUTES))
+            backlog_manager.update_track(track["track_id"], {
+                "attempts": attempts,
+                "next_retry_at": (now + backoff).isoformat()
+            })
+            logger.warning(f"Failed to download: {track_name}, retrying in {backoff} (attempt {attempts})")
+        
+        if given_up:
+            backlog_manager.move_to_failed(given_up)
+            logger.info(f"Moved {len(given_up)} track(s) to {backlog_manager.failed_file}")
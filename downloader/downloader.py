@@ -3,11 +3,9 @@ Spotify Downloader Service
 Processes backlog and downloads tracks
 """
 import os
-import time
 import signal
-import sys
 import logging
-from pathlib import Path
+import threading
 
 from downloader.backlog_manager import BacklogManager
 from downloader.download_processor import DownloadProcessor
@@ -31,7 +29,7 @@ class SpotifyDownloaderService:
         
         # Configuration
         self.download_folder = os.getenv("DOWNLOAD_FOLDER", "/app/downloads")
-        self.backlog_file = os.getenv("BACKLOG_FILE", "/app/data/backlog.json")
+        self.backlog_file = os.getenv("BACKLOG_FILE", "/app/data/backlog.jsonl")
         self.download_interval = int(os.getenv("DOWNLOAD_INTERVAL", "900"))  # seconds (default: 15 minutes)
         
         # Validate required env vars
@@ -49,7 +47,8 @@ class SpotifyDownloaderService:
             self.download_folder
         )
         
-        self.running = True
+        # Set by the signal handler; sleeping on it lets shutdown interrupt the wait
+        self._stop = threading.Event()
         
         # Setup signal handlers
         signal.signal(signal.SIGINT, self._signal_handler)
@@ -71,8 +70,7 @@ class SpotifyDownloaderService:
     def _signal_handler(self, signum, frame):
         """Handle shutdown signals"""
         logger.info("Received shutdown signal, shutting down downloader...")
-        self.running = False
-        sys.exit(0)
+        self._stop.set()
     
     def run(self):
         """Run the downloader service"""
@@ -81,8 +79,12 @@ class SpotifyDownloaderService:
         logger.info(f"Backlog file: {self.backlog_file}")
         logger.info(f"Download folder: {self.download_folder}")
         
-        while self.running:
+        while not self._stop.is_set():
             try:
+                # Logs in once, not on every downloaded track; a failed login
+                # (network down at startup) is retried on the next run
+                self.processor._initialize_zotify()
+                
                 logger.debug("Processing backlog...")
                 
                 backlog_size = self.backlog.get_backlog_size()
@@ -94,12 +96,14 @@ class SpotifyDownloaderService:
                 else:
                     logger.debug("Backlog is empty, nothing to process.")
                 
-                # Sleep for the downloader interval
-                time.sleep(self.download_interval)
+                # Sleep for the downloader interval (returns early on shutdown)
+                self._stop.wait(self.download_interval)
                 
             except Exception as e:
-                logger.error(f"Error in downloader loop: {e}", exc_info=True)
-                time.sleep(self.download_interval)
+                logger.exception(f"Error in downloader loop: {e}")
+                self._stop.wait(self.download_interval)
+        
+        logger.info("Spotify Downloader Service stopped")
 
 
 if __name__ == "__main__":
@@ -2,81 +2,283 @@
 Spotify API Listener Service
 Monitors the listening account's currently playing track using Spotify Web API
 """
-import os
 import time
-import requests
+import functools
+import asyncio
+import aiohttp
 import logging
-from typing import Optional, Dict
+import random
+import urllib.parse
+from dataclasses import dataclass
+from typing import Optional, Dict, Tuple
 import json
-from datetime import datetime
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 logger = logging.getLogger(__name__)
 
+# Both accept the raw response bytes
+_loads = orjson.loads if orjson is not None else json.loads
+
+_TOKEN_URL = "https://accounts.spotify.com/api/token"
+_API_BASE = "https://api.spotify.com/v1"
+# Statuses retried by _send, sleeping Retry-After or 0.5, 1, 2, 4, 8s (plus jitter) between tries
+_RETRY_STATUSES = frozenset({429, 502, 503, 504})
+_MAX_RETRIES = 5
+_MAX_RETRY_AFTER = 60  # seconds; for longer waits requests are skipped until the time is up
+MAX_IN_FLIGHT = 64  # concurrent requests to Spotify across listeners sharing a semaphore
+
+# time.monotonic() until which each host asked (via Retry-After) not to be called,
+# shared by every listener in the process
+_blocked_until: Dict[str, float] = {}
+
+
+class SpotifyBackoffError(Exception):
+    """Request not sent (or abandoned) while backing off from a rate-limited host or shutting down"""
+
+
+@functools.lru_cache(maxsize=16)
+def _full_url(endpoint: str) -> str:
+    """Web API URL of an endpoint path; the listener only uses a handful"""
+    return _API_BASE + endpoint
+
+
+def _retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds from a Retry-After header, None if absent or not a number of seconds"""
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+@dataclass(frozen=True)
+class Track:
+    """Currently playing track as reported by the Spotify Web API"""
+    # Listed by hand: dataclass(slots=True) needs Python 3.10
+    __slots__ = (
+        "track_id", "track_name", "artists", "album", "spotify_url",
+        "uri", "timestamp_ns", "is_playing", "progress_ms", "duration_ms"
+    )
+    
+    track_id: str
+    track_name: str
+    artists: Tuple[str, ...]
+    album: str
+    spotify_url: str
+    uri: str
+    timestamp_ns: int  # time.time_ns() at detection; formatted when written to the backlog
+    is_playing: bool
+    progress_ms: int
+    duration_ms: int
+    
+    def to_dict(self) -> Dict:
+        """Backlog entry for this track"""
+        return {
+            "track_id": self.track_id,
+            "track_name": self.track_name,
+            "artists": list(self.artists),
+            "album": self.album,
+            "spotify_url": self.spotify_url,
+            "uri": self.uri,
+            "timestamp_ns": self.timestamp_ns,
+            "is_playing": self.is_playing,
+            "progress_ms": self.progress_ms,
+            "duration_ms": self.duration_ms
+        }
+
 
 class SpotifyListener:
     """Monitors Spotify Web API for currently playing tracks"""
     
-    def __init__(self, client_id: str, client_secret: str, refresh_token: str):
+    def __init__(self, client_id: str, client_secret: str, refresh_token: str,
+                 session: aiohttp.ClientSession,
+                 semaphore: Optional[asyncio.Semaphore] = None,
+                 stop: Optional[asyncio.Event] = None):
         self.client_id = client_id
         self.client_secret = client_secret
         self.refresh_token = refresh_token
         self.access_token: Optional[str] = None
         self.token_expires_at: float = 0
         self.last_track_id: Optional[str] = None
+        # Result of the latest poll (None when nothing is playing); lets the caller
+        # time the next poll from progress_ms/duration_ms
+        self.last_track: Optional[Track] = None
+        
+        # Conditional GET state per endpoint: a 304 answers with the cached payload
+        self._etags: Dict[str, str] = {}
+        self._payloads: Dict[str, Dict] = {}
+        self._fetched_at: Dict[str, float] = {}  # time.monotonic() of the last 200
+        # Set once Spotify answers invalid_grant (revoked or expired refresh token);
+        # no further requests are made until the service is restarted with a new token
+        self._refresh_token_dead = False
+        
+        # The refresh request never changes, so encode it once
+        self._refresh_body = urllib.parse.urlencode({
+            "grant_type": "refresh_token",
+            "refresh_token": refresh_token,
+            "client_id": client_id,
+            "client_secret": client_secret
+        }).encode()
+        self._refresh_headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        # Sent with every API call; Authorization is updated when the token is refreshed
+        self._headers = {"Authorization": "", "Content-Type": "application/json"}
+        
+        # Owned by the caller (shared with other listeners, closed when the loop ends)
+        self._session = session
+        # Bounds requests in flight; shared the same way as the session
+        self._semaphore = semaphore
+        # Set on shutdown; cuts retry waits short
+        self._stop = stop
+        # Serializes token refreshes so concurrent callers share one POST; created
+        # on first refresh since Python 3.9 binds asyncio primitives to the current loop
+        self._refresh_lock: Optional[asyncio.Lock] = None
+    
+    async def _sleep(self, seconds: float):
+        """Sleep between retries; raises SpotifyBackoffError if shutdown starts meanwhile"""
+        if self._stop is None:
+            await asyncio.sleep(seconds)
+            return
+        try:
+            await asyncio.wait_for(self._stop.wait(), seconds)
+        except asyncio.TimeoutError:
+            return
+        raise SpotifyBackoffError("Shutting down")
+    
+    async def _send(self, method: str, url: str, **kwargs) -> Tuple[aiohttp.ClientResponse, bytes]:
+        """
+        Send a request, retrying rate-limited (429) and gateway (502-504) responses
+        Returns the released response together with its body. Raises SpotifyBackoffError
+        instead of sending while the host's Retry-After is more than _MAX_RETRY_AFTER away
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(MAX_IN_FLIGHT)
+        host = urllib.parse.urlsplit(url).netloc
         
-    def _get_access_token(self) -> str:
-        """Get or refresh access token"""
+        delay = 0.5
+        for retry in range(_MAX_RETRIES + 1):
+            # Honour a Retry-After received by any listener for this host
+            blocked = _blocked_until.get(host, 0) - time.monotonic()
+            if blocked > _MAX_RETRY_AFTER:
+                raise SpotifyBackoffError(f"{host} is rate limited for another {blocked:.0f}s")
+            if blocked > 0:
+                await self._sleep(blocked + random.uniform(0, delay))
+            
+            async with self._semaphore:
+                async with self._session.request(method, url, **kwargs) as response:
+                    body = await response.read()
+            
+            if response.status not in _RETRY_STATUSES:
+                return response, body
+            retry_after = _retry_after(response.headers.get("Retry-After"))
+            if retry_after is not None:
+                _blocked_until[host] = time.monotonic() + retry_after
+            if retry == _MAX_RETRIES:
+                return response, body
+            
+            if retry_after is not None:
+                if retry_after > _MAX_RETRY_AFTER:
+                    logger.warning(f"{url} returned {response.status}, not calling {host} for {retry_after:.0f}s")
+                    raise SpotifyBackoffError(f"{host} asked to wait {retry_after:.0f}s")
+                # Slept at the top of the loop
+                logger.warning(f"{url} returned {response.status}, retrying in {retry_after:.0f}s")
+            else:
+                wait = delay + random.uniform(0, delay)
+                logger.warning(f"{url} returned {response.status}, retrying in {wait:.1f}s")
+                await self._sleep(wait)
+            delay *= 2
+        return response, body
+    
+    async def _get_access_token(self) -> Optional[str]:
+        """Get or refresh access token, None if the refresh token has been rejected"""
+        if self._refresh_token_dead:
+            return None
         if self.access_token and time.time() < self.token_expires_at:
             # Type assertion: we know it's not None because of the check above
             assert self.access_token is not None
             return self.access_token
         
+        if self._refresh_lock is None:
+            self._refresh_lock = asyncio.Lock()
+        async with self._refresh_lock:
+            # Another caller may have refreshed (or hit invalid_grant) while we waited
+            if self._refresh_token_dead:
+                return None
+            if self.access_token and time.time() < self.token_expires_at:
+                return self.access_token
+            return await self._refresh_access_token()
+    
+    async def _refresh_access_token(self) -> Optional[str]:
+        """POST the refresh token to the token endpoint; callers hold _refresh_lock"""
         logger.debug("Refreshing access token")
-        url = "https://accounts.spotify.com/api/token"
-        data = {
-            "grant_type": "refresh_token",
-            "refresh_token": self.refresh_token,
-            "client_id": self.client_id,
-            "client_secret": self.client_secret
-        }
-        
         try:
-            response = requests.post(url, data=data)
+            response, body = await self._send(
+                "POST", _TOKEN_URL, data=self._refresh_body, headers=self._refresh_headers
+            )
+            if response.status == 400:
+                error_data = _loads(body)
+                if error_data.get("error") == "invalid_grant":
+                    self._refresh_token_dead = True
+                    logger.error(
+                        "Refresh token rejected by Spotify (invalid_grant); "
+                        "run get_refresh_token.py and restart with the new LISTENING_REFRESH_TOKEN"
+                    )
+                    return None
             response.raise_for_status()
+            token_data = _loads(body)
             
-            token_data = response.json()
             access_token = token_data.get("access_token")
             if not access_token:
                 raise ValueError("No access token in response")
             
             self.access_token = access_token
+            self._headers["Authorization"] = "Bearer " + access_token
             expires_in = token_data.get("expires_in", 3600)
             self.token_expires_at = time.time() + expires_in - 60  # Refresh 1 min early
             
             logger.debug(f"Access token refreshed, expires in {expires_in}s")
             return access_token
-        except requests.exceptions.RequestException as e:
+        except aiohttp.ClientError as e:
             logger.error(f"Failed to refresh access token: {e}")
             raise
     
-    def _make_api_request(self, endpoint: str, params: Optional[Dict] = None) -> Optional[Dict]:
+    async def _make_api_request(self, endpoint: str, params: Optional[Dict] = None) -> Optional[Dict]:
         """Make authenticated API request"""
-        token = self._get_access_token()
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json"
-        }
+        if await self._get_access_token() is None:
+            return None
+        
+        headers = self._headers
+        etag = self._etags.get(endpoint)
+        if etag:
+            headers["If-None-Match"] = etag
+        else:
+            headers.pop("If-None-Match", None)
         
-        url = f"https://api.spotify.com/v1{endpoint}"
-        response = requests.get(url, headers=headers, params=params)
+        response, body = await self._send("GET", _full_url(endpoint), headers=headers, params=params)
+        if response.status == 304:  # Not modified, reuse the last payload
+            return self._payloads.get(endpoint)
         
-        if response.status_code == 204:  # No content (not playing)
+        if response.status == 204:  # No content (not playing)
+            self._etags.pop(endpoint, None)
+            self._payloads.pop(endpoint, None)
             return None
-            
+        
         response.raise_for_status()
-        return response.json()
+        data = _loads(body)
+        
+        etag = response.headers.get("ETag")
+        if etag:
+            self._etags[endpoint] = etag
+            self._payloads[endpoint] = data
+            self._fetched_at[endpoint] = time.monotonic()
+        else:
+            self._etags.pop(endpoint, None)
+            self._payloads.pop(endpoint, None)
+        return data
     
-    def get_currently_playing(self, market: Optional[str] = None) -> Optional[Dict]:
+    async def get_currently_playing(self, market: Optional[str] = None) -> Optional[Track]:
         """
         Get currently playing track from listening account
         
@@ -87,14 +289,16 @@ class SpotifyListener:
                    to apply Track Relinking. If not specified, the user's market is used.
         
         Returns:
-            Track info dict or None if nothing is playing
+            Track or None if nothing is playing
         """
         try:
             params = {"market": market} if market else None
             
-            data = self._make_api_request("/me/player/currently-playing", params=params)
+            endpoint = "/me/player/currently-playing"
+            data = await self._make_api_request(endpoint, params=params)
             
-            if not data or "item" not in data or data["item"] is None:
+            track = data.get("item") if data else None
+            if track is None:
                 return None
             
             # Check if it's actually a track (not an episode)
@@ -102,43 +306,60 @@ class SpotifyListener:
             if currently_playing_type != "track":
                 return None
             
-            track = data["item"]
+            is_playing = data.get("is_playing", False)
+            duration_ms = track.get("duration_ms", 0)
+            progress_ms = data.get("progress_ms") or 0
+            if is_playing and data is self._payloads.get(endpoint):
+                # Possibly a cached payload from a 304: advance progress by the time since it was fetched
+                elapsed_ms = int((time.monotonic() - self._fetched_at[endpoint]) * 1000)
+                progress_ms = min(progress_ms + elapsed_ms, duration_ms)
             
-            # Extract track information according to API response structure
-            return {
-                "track_id": track["id"],
-                "track_name": track["name"],
-                "artists": [artist["name"] for artist in track.get("artists", [])],
-                "album": track.get("album", {}).get("name", "Unknown Album"),
-                "spotify_url": track.get("external_urls", {}).get("spotify", ""),
-                "uri": track.get("uri", ""),
-                "timestamp": datetime.now().isoformat(),
-                "is_playing": data.get("is_playing", False),
-                "progress_ms": data.get("progress_ms", 0),
-                "duration_ms": track.get("duration_ms", 0)
-            }
-        except requests.exceptions.HTTPError as e:
-            if e.response.status_code == 204:
+            # Extract track information according to API response structure.
+            # Spotify may send null for these objects, so fall back on `or`
+            artists = track.get("artists") or ()
+            album = track.get("album") or {}
+            external_urls = track.get("external_urls") or {}
+            return Track(
+                track_id=track["id"],
+                track_name=track["name"],
+                artists=tuple(artist["name"] for artist in artists),
+                album=album.get("name", "Unknown Album"),
+                spotify_url=external_urls.get("spotify", ""),
+                uri=track.get("uri", ""),
+                timestamp_ns=time.time_ns(),
+                is_playing=is_playing,
+                progress_ms=progress_ms,
+                duration_ms=duration_ms
+            )
+        except SpotifyBackoffError as e:
+            logger.debug(f"Skipped currently playing check: {e}")
+            return None
+        except aiohttp.ClientResponseError as e:
+            if e.status == 204:
                 # 204 No Content means no active playback
                 logger.debug("No active playback (204 No Content)")
                 return None
             logger.warning(f"HTTP error getting currently playing track: {e}")
             raise
         except Exception as e:
-            logger.error(f"Error getting currently playing track: {e}", exc_info=True)
+            logger.exception(f"Error getting currently playing track: {e}")
             return None
     
-    def check_for_new_track(self) -> Optional[Dict]:
+    async def check_for_new_track(self) -> Optional[Track]:
         """
         Check if a new track is playing (different from last checked)
-        Returns track info if new track detected, None otherwise
+        Returns the Track if a new track is detected, None otherwise
         """
-        current_track = self.get_currently_playing()
+        if self._refresh_token_dead:
+            return None
+        
+        current_track = await self.get_currently_playing()
+        self.last_track = current_track
         
-        if not current_track or not current_track.get("is_playing"):
+        if not current_track or not current_track.is_playing:
             return None
             
-        track_id = current_track["track_id"]
+        track_id = current_track.track_id
         
         # If this is a new track, update last_track_id and return it
         if track_id != self.last_track_id:
@@ -1,15 +1,16 @@
 """
 Spotify Watcher Service
-Monitors Spotify account and adds tracks to backlog
+Monitors Spotify accounts and adds tracks to backlog
 """
 import os
-import time
 import signal
-import sys
+import asyncio
 import logging
-from pathlib import Path
+import aiohttp
+from collections import OrderedDict
+from typing import Iterable, List, Optional, Tuple
 
-from downloader.spotify_listener import SpotifyListener
+from downloader.spotify_listener import SpotifyListener, Track, MAX_IN_FLIGHT
 from downloader.backlog_manager import BacklogManager
 
 # Configure logging
@@ -20,41 +21,55 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+RECENT_TRACKS_MAX = 1024  # stored track ids remembered to skip re-queueing replays
+
 
 class SpotifyWatcherService:
     """Service that monitors Spotify and adds tracks to backlog"""
     
-    def __init__(self):
+    def __init__(self, accounts: Optional[Iterable[Tuple[str, str, str]]] = None):
+        """
+        Args:
+            accounts: (client_id, client_secret, refresh_token) of each listening account.
+                     Read from LISTENING_* (and LISTENING_*_2, _3, ...) env vars if not given.
+        """
         # Listening account credentials (Spotify Web API)
         self.listening_client_id = os.getenv("LISTENING_CLIENT_ID")
         self.listening_client_secret = os.getenv("LISTENING_CLIENT_SECRET")
         self.listening_refresh_token = os.getenv("LISTENING_REFRESH_TOKEN")
         
         # Configuration
-        self.backlog_file = os.getenv("BACKLOG_FILE", "/app/data/backlog.json")
+        self.backlog_file = os.getenv("BACKLOG_FILE", "/app/data/backlog.jsonl")
         self.check_interval = int(os.getenv("LISTEN_CHECK_INTERVAL", "30"))  # seconds
+        # Upper bound on the wait for the current track to end, so skips are still noticed
+        self.check_interval_max = int(os.getenv("LISTEN_CHECK_INTERVAL_MAX", "300"))  # seconds
         
-        # Validate required env vars
-        self._validate_config()
-        
-        # Type assertions after validation (guaranteed to be non-None)
-        assert self.listening_client_id is not None, "LISTENING_CLIENT_ID must be set"
-        assert self.listening_client_secret is not None, "LISTENING_CLIENT_SECRET must be set"
-        assert self.listening_refresh_token is not None, "LISTENING_REFRESH_TOKEN must be set"
+        if accounts is None:
+            # Validate required env vars
+            self._validate_config()
+            
+            # Type assertions after validation (guaranteed to be non-None)
+            assert self.listening_client_id is not None, "LISTENING_CLIENT_ID must be set"
+            assert self.listening_client_secret is not None, "LISTENING_CLIENT_SECRET must be set"
+            assert self.listening_refresh_token is not None, "LISTENING_REFRESH_TOKEN must be set"
+            
+            accounts = [
+                (self.listening_client_id, self.listening_client_secret, self.listening_refresh_token),
+                *self._extra_accounts()
+            ]
+        self.accounts: List[Tuple[str, str, str]] = list(accounts)
         
-        # Initialize components
-        self.listener = SpotifyListener(
-            self.listening_client_id,
-            self.listening_client_secret,
-            self.listening_refresh_token
-        )
+        # Initialize components; listeners are created in _run() around a shared HTTP session
+        self.listeners: List[SpotifyListener] = []
         self.backlog = BacklogManager(self.backlog_file)
         
-        self.running = True
-        
-        # Setup signal handlers
-        signal.signal(signal.SIGINT, self._signal_handler)
-        signal.signal(signal.SIGTERM, self._signal_handler)
+        # Set by the signal handler; sleeping on it lets shutdown interrupt the wait.
+        # Created inside the event loop by _run()
+        self._stop: Optional[asyncio.Event] = None
+        # Detected tracks waiting for the backlog writer; None tells it to finish
+        self._backlog_q: Optional[asyncio.Queue] = None
+        # LRU of track ids the writer has stored (or found already stored), shared by all listeners
+        self._recent: "OrderedDict[str, None]" = OrderedDict()
     
     def _validate_config(self):
         """Validate that all required environment variables are set"""
@@ -70,37 +85,134 @@ class SpotifyWatcherService:
             raise ValueError(f"Missing required environment variables: {', '.join(missing)}")
         logger.info("Configuration validated successfully")
     
-    def _signal_handler(self, signum, frame):
+    def _extra_accounts(self) -> List[Tuple[str, str, str]]:
+        """Additional listening accounts from LISTENING_*_2, LISTENING_*_3, ... env vars"""
+        accounts = []
+        n = 2
+        while os.getenv(f"LISTENING_CLIENT_ID_{n}"):
+            names = [f"LISTENING_CLIENT_ID_{n}", f"LISTENING_CLIENT_SECRET_{n}", f"LISTENING_REFRESH_TOKEN_{n}"]
+            values = [os.getenv(name) for name in names]
+            missing = [name for name, value in zip(names, values) if not value]
+            if missing:
+                logger.error(f"Missing required environment variables: {', '.join(missing)}")
+                raise ValueError(f"Missing required environment variables: {', '.join(missing)}")
+            accounts.append((values[0], values[1], values[2]))
+            n += 1
+        return accounts
+    
+    def _signal_handler(self):
         """Handle shutdown signals"""
         logger.info("Received shutdown signal, shutting down watcher...")
-        self.running = False
-        sys.exit(0)
+        assert self._stop is not None
+        self._stop.set()
+    
+    async def _wait(self, timeout: float):
+        """Sleep for timeout seconds, returning early on shutdown"""
+        assert self._stop is not None
+        try:
+            await asyncio.wait_for(self._stop.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
     
     def run(self):
         """Run the watcher service"""
         logger.info("Starting Spotify Watcher Service...")
-        logger.info(f"Monitoring account for currently playing tracks (checking every {self.check_interval}s)")
+        logger.info(
+            f"Monitoring {len(self.accounts)} account(s) for currently playing tracks (checking at track end, at most every "
+            f"{self.check_interval_max}s while playing and every {self.check_interval}s otherwise)"
+        )
         logger.info(f"Backlog file: {self.backlog_file}")
         
-        while self.running:
+        asyncio.run(self._run())
+        logger.info("Spotify Watcher Service stopped")
+    
+    async def _run(self):
+        """Poll loop; runs until a shutdown signal sets the stop event"""
+        self._stop = asyncio.Event()
+        
+        # Setup signal handlers
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGINT, self._signal_handler)
+        loop.add_signal_handler(signal.SIGTERM, self._signal_handler)
+        
+        # A single writer appends to the backlog so polls never wait on disk I/O
+        self._backlog_q = asyncio.Queue(maxsize=1024)
+        writer = asyncio.create_task(self._backlog_writer())
+        
+        # One connection pool and one in-flight request limit for every listener
+        connector = aiohttp.TCPConnector(
+            limit=MAX_IN_FLIGHT, limit_per_host=MAX_IN_FLIGHT, keepalive_timeout=85
+        )
+        semaphore = asyncio.Semaphore(MAX_IN_FLIGHT)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            self.listeners = [
+                SpotifyListener(
+                    client_id, client_secret, refresh_token,
+                    session=session, semaphore=semaphore, stop=self._stop
+                )
+                for client_id, client_secret, refresh_token in self.accounts
+            ]
+            await asyncio.gather(*(self._watch(listener) for listener in self.listeners))
+        
+        # Let the writer store what is still queued before exiting
+        await self._backlog_q.put(None)
+        await writer
+    
+    async def _backlog_writer(self):
+        """Append queued tracks to the backlog until the None sentinel arrives"""
+        assert self._backlog_q is not None
+        while True:
+            track: Optional[Track] = await self._backlog_q.get()
+            if track is None:
+                return
+            
+            try:
+                # File I/O under flock; keep it off the event loop
+                if await asyncio.to_thread(self.backlog.add_track, track.to_dict()):
+                    logger.info(f"Added to backlog: {track.track_name}")
+                else:
+                    logger.debug(f"Track already in backlog: {track.track_name}")
+                # Only once it is in the backlog, so a failed write is retried on replay
+                self._recent[track.track_id] = None
+                if len(self._recent) > RECENT_TRACKS_MAX:
+                    self._recent.popitem(last=False)
+            except Exception as e:
+                logger.exception(f"Error adding {track.track_name} to backlog: {e}")
+    
+    def _next_poll_delay(self, listener: SpotifyListener) -> float:
+        """Seconds until the playing track should end, or check_interval when nothing is playing"""
+        track = listener.last_track
+        if not track or not track.is_playing:
+            return self.check_interval
+        
+        remaining = (track.duration_ms - track.progress_ms) / 1000 + 1
+        return min(max(2, remaining), self.check_interval_max)
+    
+    async def _watch(self, listener: SpotifyListener):
+        """Check one account for new tracks, polling again when the current track is expected to end"""
+        assert self._stop is not None and self._backlog_q is not None
+        while not self._stop.is_set():
             try:
-                new_track = self.listener.check_for_new_track()
+                new_track = await listener.check_for_new_track()
                 
-                if new_track:
-                    track_name = new_track.get("track_name", "Unknown")
-                    artists = ", ".join(new_track.get("artists", []))
+                if new_track and new_track.track_id in self._recent:
+                    self._recent.move_to_end(new_track.track_id)
+                    logger.debug(f"Track recently queued, skipping: {new_track.track_name}")
+                elif new_track:
+                    track_name = new_track.track_name
+                    artists = ", ".join(new_track.artists)
                     logger.info(f"New track detected: {track_name} by {artists}")
                     
-                    if self.backlog.add_track(new_track):
-                        logger.info(f"Added to backlog: {track_name}")
-                    else:
-                        logger.debug(f"Track already in backlog: {track_name}")
+                    try:
+                        self._backlog_q.put_nowait(new_track)
+                    except asyncio.QueueFull:
+                        logger.warning(f"Backlog queue full, dropping: {track_name}")
                 
-                time.sleep(self.check_interval)
+                await self._wait(self._next_poll_delay(listener))
                 
             except Exception as e:
-                logger.error(f"Error in watcher loop: {e}", exc_info=True)
-                time.sleep(self.check_interval)
+                logger.exception(f"Error in watcher loop: {e}")
+                await self._wait(self.check_interval)
 
 
 if __name__ == "__main__":
@@ -8,7 +8,15 @@ import base64
 import requests
 import webbrowser
 from http.server import HTTPServer, BaseHTTPRequestHandler
-import threading
+import time
+import traceback
+
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    import json
+    _loads = json.loads
 
 # Get credentials from user
 print("=" * 60)
@@ -51,15 +59,15 @@ print()
 webbrowser.open(auth_url_with_params)
 
 # Step 2: Start local server to receive callback
-authorization_code = None
+# The handler stores the code in auth_result; the main thread serves requests until it is set
+auth_result = {}
 
 class CallbackHandler(BaseHTTPRequestHandler):
     def do_GET(self):
-        global authorization_code
         if self.path.startswith("/callback"):
             query_params = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
             if "code" in query_params:
-                authorization_code = query_params["code"][0]
+                auth_result["code"] = query_params["code"][0]
                 self.send_response(200)
                 self.send_header("Content-type", "text/html")
                 self.end_headers()
@@ -101,22 +109,22 @@ print("(Press Ctrl+C to cancel)")
 print()
 
 server = HTTPServer(("localhost", port), CallbackHandler)
-server_thread = threading.Thread(target=server.serve_forever, daemon=True)
-server_thread.start()
 
 try:
-    # Wait for authorization code (with timeout)
-    import time
+    # Wait for authorization code (with timeout), one request at a time on this thread;
+    # anything before the callback (favicon, failed attempts) just loops again
     timeout = 300  # 5 minutes
-    start_time = time.time()
-    while authorization_code is None:
-        if time.time() - start_time > timeout:
+    deadline = time.monotonic() + timeout
+    while "code" not in auth_result:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
             print("\nTimeout waiting for authorization. Please try again.")
-            server.shutdown()
+            server.server_close()
             exit(1)
-        time.sleep(0.5)
+        server.timeout = remaining
+        server.handle_request()
     
-    server.shutdown()
+    server.server_close()
     
     print("Authorization code received!")
     print()
@@ -128,25 +136,24 @@ try:
     
     token_url = "https://accounts.spotify.com/api/token"
     
-    # Prepare credentials
-    credentials = f"{CLIENT_ID}:{CLIENT_SECRET}"
-    encoded_credentials = base64.b64encode(credentials.encode()).decode()
+    # Prepare credentials (requests accepts bytes header values as-is)
+    auth_header = b"Basic " + base64.b64encode(f"{CLIENT_ID}:{CLIENT_SECRET}".encode())
     
     headers = {
-        "Authorization": f"Basic {encoded_credentials}",
+        "Authorization": auth_header,
         "Content-Type": "application/x-www-form-urlencoded"
     }
     
-    data = {
+    body = urllib.parse.urlencode({
         "grant_type": "authorization_code",
-        "code": authorization_code,
+        "code": auth_result["code"],
         "redirect_uri": REDIRECT_URI
-    }
+    }).encode()
     
-    response = requests.post(token_url, headers=headers, data=data)
+    response = requests.post(token_url, headers=headers, data=body)
     response.raise_for_status()
     
-    token_data = response.json()
+    token_data = _loads(response.content)
     refresh_token = token_data["refresh_token"]
     access_token = token_data["access_token"]
     
@@ -167,18 +174,17 @@ try:
 
 except KeyboardInterrupt:
     print("\n\nCancelled by user.")
-    server.shutdown()
+    server.server_close()
     exit(1)
 except requests.exceptions.HTTPError as e:
     print(f"\nError getting refresh token: {e}")
     if e.response is not None:
         print(f"Response: {e.response.text}")
-    server.shutdown()
+    server.server_close()
     exit(1)
 except Exception as e:
     print(f"\nUnexpected error: {e}")
-    import traceback
     traceback.print_exc()
-    server.shutdown()
+    server.server_close()
     exit(1)
 